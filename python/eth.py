@@ -1,31 +1,87 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
+from __future__ import annotations
+
+import contextvars
+import functools
 import json
+import pickle
+import queue
+import sqlite3
+import sys
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal, InvalidOperation
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import click
-from cached_property import cached_property
+import eth_utils
+import orjson
+from cached_property import cached_property, threaded_cached_property
 from clk.config import config
 from clk.core import run
 from clk.decorators import argument, flag, group, option
 from clk.lib import json_dumps, parsedatetime
 from clk.log import get_logger
 from clk.types import DynamicChoice
-from eth_account import Account
-from eth_utils import to_wei
+from eth_utils import to_hex, to_wei
+from eth_utils.currency import MAX_WEI, MIN_WEI
 from eth_utils.units import units
-from hexbytes.main import HexBytes
-from web3 import Web3
-from web3.datastructures import AttributeDict
+
+if TYPE_CHECKING:
+    from web3 import Web3
 
 LOGGER = get_logger(__name__)
 
+# above that, nodes tend to answer batches more slowly than individual requests
+RECEIPTS_BATCH_SIZE = 100
+# how many blocks to fetch in advance while walking the chain
+BLOCKS_PREFETCH_DEPTH = 16
+HTTP_POOL_SIZE = 16
+# Polygon, BNB, their testnets, Goerli and geth --dev, that need the proof of
+# authority middleware
+POA_CHAIN_IDS = frozenset({137, 80001, 80002, 56, 97, 5, 1337})
+# blocks closer than that to the head of the chain may still be reorganized,
+# hence are not cached
+REORG_WINDOW = 64
+
+
+@functools.lru_cache(maxsize=32)
+def _load_abi(path, mtime):
+    return json.loads(Path(path).read_text())["abi"]
+
+
+@functools.lru_cache(maxsize=32)
+def _index_abi(path, mtime):
+    abi_by_name = {}
+    for method in _load_abi(path, mtime):
+        if "name" in method:
+            # like a linear scan would, keep the first overload
+            abi_by_name.setdefault(method["name"], method)
+    return abi_by_name
+
+
+@functools.lru_cache(maxsize=8)
+def _derive_account(mnemonic, account_number):
+    # the derivation runs 2048 rounds of PBKDF2, commands run with clk.core.run
+    # in the same process should not pay for it again
+    from eth_account import Account
+
+    Account.enable_unaudited_hdwallet_features()
+    return Account.from_mnemonic(
+        mnemonic, account_path=f"m/44'/60'/0'/0/{account_number}")
+
 
 class DecimalType(click.ParamType):
 
     def convert(self, value, param, ctx):
+        try:
+            return int(value)
+        except ValueError:
+            pass
         try:
             return Decimal(value)
         except InvalidOperation:
@@ -38,22 +94,28 @@ class ContractMethod:
 
     @cached_property
     def abi(self):
-        return [
-            method for method in config.eth.abi
-            if method.get("name") == self.function
-        ][0]
+        return config.eth.abi_by_name[self.function]
 
     @cached_property
     def inputs(self):
         return self.abi["inputs"]
 
+    @cached_property
+    def inputs_by_name(self):
+        return {input["name"]: input for input in self.inputs}
+
     @cached_property
     def outputs(self):
         return self.abi.get("outputs")
 
-    @property
+    @cached_property
+    def is_view(self):
+        return self.abi["stateMutability"] == "view"
+
+    @cached_property
     def needed_names(self):
-        return {input["name"] for input in self.inputs if input["name"]}
+        return frozenset(input["name"] for input in self.inputs
+                         if input["name"])
 
     @property
     def given_names(self):
@@ -101,41 +163,285 @@ class ContractMethod:
         return config.eth.w3.eth.wait_for_transaction_receipt(tx_hash)
 
 
+class DiskCache:
+    """Store the immutable data of the chain, like finalized blocks
+
+    The database lives in the clk cache directory, like
+    ~/.cache/clk/eth/cache.sqlite, and can be removed at any time."""
+
+    def __init__(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache"
+                        " (key BLOB PRIMARY KEY, value BLOB)")
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM cache WHERE key = ?",
+                                  (key, )).fetchone()
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0])
+        except Exception as e:
+            # most likely pickled by another version of web3 or hexbytes, it
+            # will be fetched again and overwritten
+            LOGGER.debug(f"Ignoring the unreadable cache entry {key}: {e}")
+            return None
+
+    def set(self, key, value):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?)",
+                            (key, pickle.dumps(value)))
+
+
 class Eth:
 
     def __init__(self):
         self.proof_of_authority = None
 
-    def walk_blocks(self):
-        b = self.w3.eth.get_block('latest')
-        while b:
+    def walk_blocks(self, full_transactions=False):
+        b = self.w3.eth.get_block('latest', full_transactions)
+        yield b
+        for number in range(b.number - 1, -1, -1):
+            # the hash is known from the child, so that the cache can be used
+            b = self._get_block(number, b.parentHash, full_transactions)
             yield b
-            b_hash = b.get('parentHash')
-            if b_hash == HexBytes('0x000000000000000000000000000000'
-                                  '0000000000000000000000000000000000'):
-                break
-            else:
-                b = self.w3.eth.get_block(b_hash)
+
+    @threaded_cached_property
+    def cache(self):
+        import appdirs
+        return DiskCache(
+            Path(appdirs.user_cache_dir(config.app_name)) / "eth" /
+            "cache.sqlite")
+
+    @threaded_cached_property
+    def finalized_number(self):
+        return self.w3.eth.block_number - REORG_WINDOW
+
+    def _block_key(self, hash, full_transactions):
+        prefix = b"fullblock:" if full_transactions else b"block:"
+        return prefix + bytes(hash)
+
+    def _get_block(self, number, hash, full_transactions=False):
+        if (block := self.cache.get(self._block_key(
+                hash, full_transactions))) is None:
+            block = self.w3.eth.get_block(number, full_transactions)
+            if block.hash != hash:
+                # the chain was reorganized since the child was fetched, stay
+                # on the fork of the child
+                block = self.w3.eth.get_block(hash, full_transactions)
+            if block.number <= self.finalized_number:
+                self.cache.set(self._block_key(block.hash, full_transactions),
+                               block)
+        return block
+
+    def _block_receipts(self, block):
+        key = b"receipts:" + bytes(block.hash)
+        if (receipts := self.cache.get(key)) is None:
+            receipts = self._batch_receipts(block.transactions)
+            if block.number <= self.finalized_number:
+                self.cache.set(key, receipts)
+        return receipts
+
+    def prefetch_blocks(self,
+                        depth=BLOCKS_PREFETCH_DEPTH,
+                        full_transactions=False):
+        """Walk the blocks, fetching up to depth of them in the background
+
+        This way, the node is asked for the next blocks while the caller deals
+        with the current one."""
+        blocks = queue.Queue(maxsize=depth)
+        stopped = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    blocks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                self._share_session()
+                for block in self.walk_blocks(full_transactions):
+                    if not put(block):
+                        return
+            except Exception as e:
+                put(e)
+            put(end)
+
+        # the producer needs the clk config, hold in a context variable
+        threading.Thread(target=contextvars.copy_context().run,
+                         args=(produce, ),
+                         daemon=True).start()
+        try:
+            while (block := blocks.get()) is not end:
+                if isinstance(block, Exception):
+                    raise block
+                yield block
+        finally:
+            stopped.set()
 
     def walk_transactions(self, limit=None):
         accum = 0
-        for block in self.walk_blocks():
-            txs = [
-                self.w3.eth.wait_for_transaction_receipt(hash)
-                for hash in block.transactions
-            ]
+        for block in self.prefetch_blocks():
+            txs = self._block_receipts(block)
             yield from txs
             accum += len(txs)
             if limit and accum >= limit:
                 break
 
+    def _batch_request(self, method, params_list):
+        "Send all the calls to method in a single json-rpc batch request"
+        from web3._utils.request import make_post_request
+
+        payload = [{
+            "jsonrpc": "2.0",
+            "id": id,
+            "method": method,
+            "params": params,
+        } for id, params in enumerate(params_list)]
+        responses = json.loads(
+            make_post_request(self.w3.provider.endpoint_uri,
+                              json.dumps(payload).encode(),
+                              **dict(self.w3.provider.get_request_kwargs())))
+        if not isinstance(responses, list):
+            raise ValueError(f"The node does not support batches: {responses}")
+        responses = {response["id"]: response for response in responses}
+        for response in responses.values():
+            if "error" in response:
+                raise ValueError(response["error"])
+        return [responses[id]["result"] for id in range(len(params_list))]
+
+    @threaded_cached_property
+    def _pool(self):
+        # the workers share self.session, whose connection pool is as large
+        # as the number of workers
+        return ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE,
+                                  initializer=self._share_session)
+
+    @cached_property
+    def supports_batch_requests(self):
+        try:
+            self._batch_request("eth_chainId", [[]])
+        except (ValueError, OSError) as e:
+            LOGGER.debug(f"Falling back to individual requests: {e}")
+            return False
+        return True
+
+    def _individual_receipts(self, hashes):
+        return list(
+            self._pool.map(self.w3.eth.wait_for_transaction_receipt, hashes))
+
+    def _batch_receipts(self, hashes):
+        if not self.supports_batch_requests:
+            return self._individual_receipts(hashes)
+        from web3._utils.method_formatters import receipt_formatter
+        from web3.datastructures import AttributeDict
+
+        receipts = []
+        for start in range(0, len(hashes), RECEIPTS_BATCH_SIZE):
+            chunk = hashes[start:start + RECEIPTS_BATCH_SIZE]
+            if not self.supports_batch_requests:
+                receipts += self._individual_receipts(chunk)
+                continue
+            try:
+                results = self._batch_request(
+                    "eth_getTransactionReceipt",
+                    [[to_hex(hash)] for hash in chunk])
+            except (ValueError, OSError) as e:
+                # some nodes accept small batches only, like the probe
+                LOGGER.debug(f"Falling back to individual requests: {e}")
+                self.supports_batch_requests = False
+                receipts += self._individual_receipts(chunk)
+                continue
+            receipts += [
+                AttributeDict.recursive(receipt_formatter(receipt))
+                if receipt is not None else
+                self.w3.eth.wait_for_transaction_receipt(hash)
+                for hash, receipt in zip(chunk, results)
+            ]
+        return receipts
+
     @property
     def myaddress(self):
         return self.account.address
 
+    @cached_property
+    def supports_trace_filter(self):
+        try:
+            response = self.w3.provider.make_request(
+                "trace_filter", [{
+                    "fromBlock": "latest",
+                    "toBlock": "latest"
+                }])
+        except (ValueError, OSError) as e:
+            LOGGER.debug(f"Cannot use trace_filter: {e}")
+            return False
+        return "error" not in response
+
+    def _trace_filter(self, filter):
+        response = self.w3.provider.make_request("trace_filter", [filter])
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response["result"]
+
+    def history_via_trace(self, address, limit=None):
+        """The transactions involving address, as indexed by the node
+
+        Only works with nodes providing the trace_filter method, like
+        erigon."""
+        from hexbytes import HexBytes
+
+        traces = []
+        for direction in ("fromAddress", "toAddress"):
+            traces += self._trace_filter({
+                "fromBlock": "0x0",
+                "toBlock": "latest",
+                direction: [address],
+            })
+        # the block and uncle rewards are not transactions, and the internal
+        # calls would be filtered out by history anyway
+        traces = [
+            trace for trace in traces
+            if trace.get("transactionHash") and not trace.get("traceAddress")
+        ]
+        traces.sort(key=lambda trace:
+                    (trace["blockNumber"], trace["transactionPosition"]),
+                    reverse=True)
+        hashes = list(
+            dict.fromkeys(
+                HexBytes(trace["transactionHash"]) for trace in traces))
+        yield from self._batch_receipts(hashes[:limit])
+
+    def history_via_logs(self, address, limit=None):
+        """The transactions that made the contract at address emit logs
+
+        Unlike history, this does not find the transactions that did not
+        trigger any event, but any node can answer it without walking the
+        chain."""
+        logs = self.w3.eth.get_logs({
+            "fromBlock": 0,
+            "toBlock": "latest",
+            "address": eth_utils.to_checksum_address(address),
+        })
+        hashes = list(
+            dict.fromkeys(log["transactionHash"] for log in reversed(logs)))
+        yield from self._batch_receipts(hashes[:limit])
+
     def history(self, address, limit=None):
+        if self.supports_trace_filter:
+            txs = self.history_via_trace(address, limit=limit)
+        else:
+            txs = self.walk_transactions(limit=limit)
         return (
-            tx for tx in self.walk_transactions(limit=limit)
+            tx for tx in txs
             if address in [tx.get("contractAddress"), tx["from"], tx["to"]])
 
     def myhistory(self, limit=None):
@@ -146,30 +452,78 @@ class Eth:
                     if tx["contractAddress"])
 
     def take_contracts(self, history=None):
-        yield from (
-            tx["contractAddress"]
-            for tx in self.filter_contract(history or self.myhistory()))
+        if history is not None or self.supports_trace_filter:
+            yield from (
+                tx["contractAddress"]
+                for tx in self.filter_contract(history or self.myhistory()))
+            return
+        # the contract creations are the transactions without recipient, only
+        # their receipts are needed to get the address of the contract
+        myaddress = self.myaddress
+        for block in self.prefetch_blocks(full_transactions=True):
+            hashes = [
+                tx["hash"] for tx in block.transactions
+                if not tx["to"] and tx["from"] == myaddress
+            ]
+            if hashes:
+                yield from (receipt["contractAddress"]
+                            for receipt in self._batch_receipts(hashes))
+
+    @property
+    def _abi_key(self):
+        return str(self.abi_path), self.abi_path.stat().st_mtime_ns
 
     @cached_property
     def abi(self):
-        return json.loads(self.abi_path.read_text())["abi"]
+        return _load_abi(*self._abi_key)
 
-    @property
+    @cached_property
+    def abi_by_name(self):
+        return _index_abi(*self._abi_key)
+
+    @cached_property
+    def function_names(self):
+        return list(
+            dict.fromkeys(method["name"] for method in self.abi
+                          if method.get("type") == "function"))
+
+    @cached_property
     def account(self):
-        Account.enable_unaudited_hdwallet_features()
-        return Account.from_mnemonic(
-            self.mnemonic,
-            account_path=f"m/44'/60'/0'/0/{self.account_number}")
+        return _derive_account(self.mnemonic, self.account_number)
 
-    @property
+    @threaded_cached_property
+    def session(self):
+        import requests
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _share_session(self):
+        """Make web3 use self.session in the current thread
+
+        web3 caches its sessions per thread, so without this, each thread
+        would open its own connections to the node."""
+        from web3._utils.request import cache_and_return_session
+
+        cache_and_return_session(self.url, self.session)
+
+    @threaded_cached_property
     def w3(self) -> Web3:
-        w3 = Web3(Web3.HTTPProvider(self.url))
+        from web3 import Web3
+
+        # this shares the session with the current thread only, the other
+        # threads use _share_session
+        w3 = Web3(Web3.HTTPProvider(self.url, session=self.session))
         from web3.middleware import construct_sign_and_send_raw_middleware
 
         w3.middleware_onion.add(
             construct_sign_and_send_raw_middleware(self.account))
-        if self.proof_of_authority is not False or any(
-                part in self.url for part in ["polygon"]):
+        # proof_of_authority stays None unless --proof-of-authority is given
+        if self.proof_of_authority or w3.eth.chain_id in POA_CHAIN_IDS:
             from web3.middleware import geth_poa_middleware
             w3.middleware_onion.inject(geth_poa_middleware, layer=0)
         w3.eth.default_account = self.account.address
@@ -183,10 +537,40 @@ class Eth:
 class ContractCaller(DynamicChoice):
 
     def choices(self):
-        return [
-            fct for fct in dir(config.eth.contract.caller)
-            if not fct.startswith("__") and fct not in {"address", "abi"}
-        ]
+        return config.eth.function_names
+
+
+@functools.lru_cache(maxsize=None)
+def _input_tag(type):
+    if type.endswith("[]"):
+        return "array"
+    elif type.startswith("uint"):
+        return "uint"
+    elif type == "bool":
+        return "bool"
+    elif type.startswith("byte"):
+        return "bytes"
+    else:
+        return "raw"
+
+
+def _coerce_bytes(val):
+    if val.startswith("0x"):
+        return bytes.fromhex(val[2:])
+    else:
+        # what web3's to_bytes(text=val) does, without connecting to the node
+        return val.encode("utf-8")
+
+
+_TRUTHY = frozenset(("true", "True", "1", "t", "yes"))
+
+_COERCERS = {
+    "array": json.loads,
+    "uint": int,
+    "bool": _TRUTHY.__contains__,
+    "bytes": _coerce_bytes,
+    "raw": lambda val: val,
+}
 
 
 class ContractCallerArgs(DynamicChoice):
@@ -197,26 +581,11 @@ class ContractCallerArgs(DynamicChoice):
 
     def coerce(self, key, val):
         if key:
-            inp = [
-                input for input in config.contractmethod.inputs
-                if input["name"] == key
-            ][0]
+            inp = config.contractmethod.inputs_by_name[key]
         else:
             inp = config.contractmethod.inputs[self.number - 1]
             key = inp["name"]
-        if inp["type"].endswith("[]"):
-            val = json.loads(val)
-        elif inp["type"].startswith("uint"):
-            val = int(val)
-        elif inp["type"] == "bool":
-            val = val in ("true", "True", "1", "t", "yes")
-        elif inp["type"].startswith("byte"):
-            if val.startswith("0x"):
-                val = bytes.fromhex(val[2:])
-            else:
-                val = config.eth.w3.to_bytes(text=val)
-
-        return key, val
+        return key, _COERCERS[_input_tag(inp["type"])](val)
 
     def convert(self, value, param, ctx):
         self.number += 1
@@ -254,7 +623,8 @@ class ContractCallerArgs(DynamicChoice):
 )
 @flag("--proof-of-authority",
       expose_class=Eth,
-      help="Deal with Polygon, BNB, geth --dev or Goerli")
+      help=("Deal with Polygon, BNB, geth --dev or Goerli."
+            " Guessed from the chain id for the known ones"))
 def eth():
     "Play with some web3 stuff"
 
@@ -322,7 +692,7 @@ def mine():
 @argument("address", help="The address to transform")
 def to_checksum_address(address):
     "Print the checksum valid representation of this address"
-    print(Web3.to_checksum_address(address))
+    print(eth_utils.to_checksum_address(address))
 
 
 @eth.command()
@@ -332,6 +702,10 @@ def ipython():
     w = e.w3
     eth = w.eth
     import IPython
+    from eth_account import Account
+    from hexbytes import HexBytes
+    from web3 import Web3
+    from web3.datastructures import AttributeDict
     IPython.start_ipython(argv=[], user_ns=(globals() | locals()))
 
 
@@ -367,25 +741,38 @@ def _ipython():
     w = e.w3
     eth = w.eth
     import IPython
+    from eth_account import Account
+    from hexbytes import HexBytes
+    from web3 import Web3
+    from web3.datastructures import AttributeDict
     IPython.start_ipython(argv=[], user_ns=(globals() | locals()))
 
 
-def serializable_dict(data):
-    return {
-        make_serializable(key): make_serializable(value)
-        for key, value in data.items()
-    }
+def _default(data):
+    # checking the abstract types avoids importing hexbytes and web3
+    if isinstance(data, bytes):
+        return data.hex()
+    elif isinstance(data, Mapping):
+        return dict(data)
+    raise TypeError(f"Type is not JSON serializable: {type(data).__name__}")
 
 
-def make_serializable(data):
-    if isinstance(data, AttributeDict) or isinstance(data, dict):
-        return serializable_dict(data)
-    elif isinstance(data, HexBytes):
-        return data.hex()
-    elif isinstance(data, list):
-        return [make_serializable(elem) for elem in data]
-    else:
-        return data
+def emit(items):
+    """Write each item as a line of json on the standard output
+
+    The items are written as soon as they are produced, so that only one of
+    them is in memory at a time."""
+    write = sys.stdout.buffer.write
+    dumps = orjson.dumps
+    option = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+              | orjson.OPT_APPEND_NEWLINE)
+    for item in items:
+        write(dumps(item, default=_default, option=option))
+
+
+def dump(data):
+    "Write data as a line of json on the standard output"
+    emit((data, ))
 
 
 @contract.command()
@@ -410,15 +797,15 @@ def _call(transact):
     if not config.contractmethod.check():
         exit(1)
     if transact is None:
-        transact = config.contractmethod.abi["stateMutability"] != "view"
+        transact = not config.contractmethod.is_view
     else:
         transact = transact and (
-            config.contractmethod.abi["stateMutability"] != "view"
+            not config.contractmethod.is_view
             or click.confirm("Transacting a view. Are you sure?"))
 
     if transact:
         hash = config.contractmethod.transact()
-        print(json_dumps(make_serializable(hash)))
+        dump(hash)
     else:
         print(config.contractmethod.call())
 
@@ -463,9 +850,16 @@ def balance(address, unit):
 
 @eth.command()
 @argument("address")
-def history(address):
-    for history_ in config.eth.history(address):
-        print(json_dumps(make_serializable(history_)))
+@flag("--logs",
+      help=("Only show the transactions that made the contract"
+            " at this address emit events, using eth_getLogs"))
+def history(address, logs):
+    "Show the transactions involving the given address"
+    if logs:
+        history = config.eth.history_via_logs(address)
+    else:
+        history = config.eth.history(address)
+    emit(history)
 
 
 @eth.command()
@@ -478,10 +872,20 @@ def history(address):
 def send(to, amount, unit):
     "Send some value to some address"
     eth: Eth = config.eth
+    if unit == "wei":
+        # the checks to_wei would have done, DecimalType accepts inf and nan
+        if (isinstance(amount, Decimal) and not amount.is_finite()
+                or not MIN_WEI <= int(amount) <= MAX_WEI):
+            raise click.UsageError(
+                f"amount: Must be between {MIN_WEI} and {MAX_WEI} wei,"
+                f" got {amount}")
+        value = int(amount)
+    else:
+        value = to_wei(amount, unit)
     result = eth.w3.eth.send_transaction({
         "from": eth.myaddress,
         "to": to,
-        "value": to_wei(amount, unit)
+        "value": value
     })
     click.echo(result.hex())
 